@@ -56,10 +56,14 @@ class SessionConfigurationException(Exception):
 class RestOperationException(Exception):
     """ Encapsulate a REST API error """
 
-    def __init__(self, error):
+    def __init__(self, error, retry_after=None, http_status=None):
         self.status = to_native(error.get("status", None))
         self.errors = [to_native(err.get("message")) for err in error.get("errors", {})]
         self.message = to_native(" ".join(self.errors))
+        # Value of the Retry-After header, if the API asked us to back off
+        self.retry_after = retry_after
+        # HTTP status code of the response, which can differ from the status in the error body
+        self.http_status = http_status
 
 
 def generate_docstring(operation_spec):
@@ -160,14 +164,21 @@ class RestOperation(object):
         except ValueError:
             result = {}
 
+        retry_after = None
+        if request_error and response.info() is not None:
+            retry_after = response.info().get("Retry-After")
+
         if result or result == {}:
             if result_code and result_code < 400:
                 return result
             else:
-                raise RestOperationException(result)
+                if "status" not in result:
+                    result["status"] = result_code
+                raise RestOperationException(result, retry_after=retry_after, http_status=result_code)
 
         # Raise a generic RestOperationException if this fails
-        raise RestOperationException({"status": result_code, "errors": [{"message": "REST Operation Failed"}]})
+        raise RestOperationException(
+            {"status": result_code, "errors": [{"message": "REST Operation Failed"}]}, retry_after=retry_after, http_status=result_code)
 
 
 class Resource(object):
@@ -36,6 +36,10 @@ notes:
   - There is a small delay (typically about 5 seconds, but can be as long as 60 seconds) before obtaining the random values
     when requesting a validation while O(verification_method=dns) or O(verification_method=web_server). Be aware of that if
     doing many domain validation requests.
+  - Concurrent runs of this module on the same host for the same O(client_id) and O(domain_name) are serialized with a
+    lock file in the system's temporary directory, so that only one of them requests a (re-)validation. A run stops waiting
+    for rate limits and random values after 210 seconds; if the lock cannot be obtained within that time plus a margin of
+    120 seconds for the requests themselves, the module continues without it.
 extends_documentation_fragment:
   - community.crypto.attributes
   - community.crypto.ecs_credential
@@ -219,10 +223,15 @@ ev_days_remaining:
 """
 
 import datetime
+import hashlib
+import os
+import tempfile
 import time
 
+from contextlib import contextmanager
+
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.common.text.converters import to_native
+from ansible.module_utils.common.text.converters import to_bytes, to_native
 
 from ansible_collections.community.crypto.plugins.module_utils.ecs.api import (
     ecs_client_argument_spec,
@@ -231,15 +240,112 @@ from ansible_collections.community.crypto.plugins.module_utils.ecs.api import (
     SessionConfigurationException,
 )
 
+from ansible_collections.community.crypto.plugins.module_utils.time import (
+    get_now_datetime,
+)
+
+try:
+    import fcntl
+except ImportError:
+    HAS_FCNTL = False
+else:
+    HAS_FCNTL = True
+
+
+# Polling parameters (in seconds) used while waiting for ECS to generate the random values
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 8.0
+POLL_BACKOFF_FACTOR = 1.6
+POLL_TIMEOUT = 60
+
+ACTIVE_DOMAIN_STATUSES = frozenset(['APPROVED', 'INITIAL_VERIFICATION', 'RE_VERIFICATION'])
+IN_PROGRESS_DOMAIN_STATUSES = frozenset(['INITIAL_VERIFICATION', 'RE_VERIFICATION'])
+
+# Retry parameters (in seconds) used when ECS rate-limits requests with HTTP 429
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_INITIAL_DELAY = 1
+RATE_LIMIT_MAX_DELAY = 30
+
+# Total time (in seconds) one run may spend sleeping, both for rate limits and while polling for the random values
+REQUEST_TIMEOUT = POLL_TIMEOUT + RATE_LIMIT_RETRIES * RATE_LIMIT_MAX_DELAY
+
+# Waiting for the domain lock (in seconds) is bounded by REQUEST_TIMEOUT of the run holding it, plus a margin for the
+# duration of its HTTP requests
+LOCK_TIMEOUT = REQUEST_TIMEOUT + 120
+LOCK_POLL_INTERVAL = 1
+
 
 def calculate_days_remaining(expiry_date):
     days_remaining = None
     if expiry_date:
         expiry_datetime = datetime.datetime.strptime(expiry_date, '%Y-%m-%dT%H:%M:%SZ')
-        days_remaining = (expiry_datetime - datetime.datetime.now()).days
+        # ECS returns expiry dates in UTC, so compare them to the current time in UTC
+        days_remaining = (expiry_datetime - get_now_datetime(with_timezone=False)).days
     return days_remaining
 
 
+def call_with_retry(operation, deadline=None, **kwargs):
+    '''
+    Call an ECS API operation, retrying a bounded number of times if ECS responds with HTTP 429 (Too Many Requests).
+    If a deadline is given, no retry is attempted after it.
+    '''
+    delay = RATE_LIMIT_INITIAL_DELAY
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            return operation(**kwargs)
+        except RestOperationException as e:
+            if e.http_status != 429 or attempt == RATE_LIMIT_RETRIES:
+                raise
+            wait = delay
+            try:
+                wait = int(e.retry_after)
+            except (TypeError, ValueError):
+                # Retry-After is missing or given as an HTTP date
+                pass
+            wait = max(0, min(wait, RATE_LIMIT_MAX_DELAY))
+            if deadline is not None and time.time() + wait > deadline:
+                raise
+            time.sleep(wait)
+            delay = min(delay * 2, RATE_LIMIT_MAX_DELAY)
+
+
+def get_domain_lock_path(client_id, domain_name):
+    return os.path.join(
+        tempfile.gettempdir(),
+        'ansible-ecs_domain-{0}-{1}.lock'.format(client_id, hashlib.sha1(to_bytes(domain_name)).hexdigest()))
+
+
+@contextmanager
+def domain_request_lock(client_id, domain_name):
+    '''
+    Serialize requests for the same domain of the same client between concurrently running module instances.
+    '''
+    if not HAS_FCNTL:
+        yield
+        return
+    try:
+        # Do not follow a symlink planted at the (predictable) lock file location
+        fd = os.open(get_domain_lock_path(client_id, domain_name), os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    except (IOError, OSError):
+        # For example if the lock file belongs to another user; continue without serialization
+        yield
+        return
+    try:
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError):
+                if time.time() >= deadline:
+                    # The lock is held for longer than any run should take; continue without serialization
+                    break
+                time.sleep(LOCK_POLL_INTERVAL)
+        yield
+    finally:
+        os.close(fd)
+
+
 class EcsDomain(object):
     '''
     Entrust Certificate Services domain class.
@@ -257,15 +363,20 @@ class EcsDomain(object):
         self.emails = None
         self.ov_eligible = None
         self.ov_days_remaining = None
-        self.ev_eligble = None
+        self.ev_eligible = None
         self.ev_days_remaining = None
         # Note that verification_method is the 'current' verification
         # method of the domain, we'll use module.params when requesting a new
         # one, in case the verification method has changed.
         self.verification_method = None
+        # Raw domain details returned by GetDomain in 'check', kept to detect new random values
+        self.previous_domain_details = {}
+        # Time after which requests are no longer retried, set when requesting the domain
+        self.deadline = None
 
         self.ecs_client = None
-        # Instantiate the ECS client and then try a no-op connection to verify credentials are valid
+        # Instantiate the ECS client. Credentials are only verified with a no-op connection
+        # once a request has failed, to avoid an additional round-trip on every run.
         try:
             self.ecs_client = ECSClient(
                 entrust_api_user=module.params['entrust_api_user'],
@@ -276,8 +387,10 @@ class EcsDomain(object):
             )
         except SessionConfigurationException as e:
             module.fail_json(msg='Failed to initialize Entrust Provider: {0}'.format(to_native(e)))
+
+    def verify_credentials(self, module):
         try:
-            self.ecs_client.GetAppVersion()
+            call_with_retry(self.ecs_client.GetAppVersion, deadline=self.deadline)
         except RestOperationException as e:
             module.fail_json(msg='Please verify credential information. Received exception when testing ECS connection: {0}'.format(to_native(e.message)))
 
@@ -302,16 +415,20 @@ class EcsDomain(object):
             self.emails = domain_details['emailMethod']
 
     def check(self, module):
+        client_id = module.params['client_id']
+        domain_name = module.params['domain_name']
+        verification_method = module.params['verification_method']
         try:
-            domain_details = self.ecs_client.GetDomain(clientId=module.params['client_id'], domain=module.params['domain_name'])
+            domain_details = call_with_retry(self.ecs_client.GetDomain, deadline=self.deadline, clientId=client_id, domain=domain_name)
+            self.previous_domain_details = domain_details
             self.set_domain_details(domain_details)
-            if self.domain_status != 'APPROVED' and self.domain_status != 'INITIAL_VERIFICATION' and self.domain_status != 'RE_VERIFICATION':
+            if self.domain_status not in ACTIVE_DOMAIN_STATUSES:
                 return False
 
             # If domain verification is in process, we want to return the random values and treat it as a valid.
-            if self.domain_status == 'INITIAL_VERIFICATION' or self.domain_status == 'RE_VERIFICATION':
+            if self.domain_status in IN_PROGRESS_DOMAIN_STATUSES:
                 # Unless the verification method has changed, in which case we need to do a reverify request.
-                if self.verification_method != module.params['verification_method']:
+                if self.verification_method != verification_method:
                     return False
 
             if self.domain_status == 'EXPIRING':
@@ -321,46 +438,87 @@ class EcsDomain(object):
         except RestOperationException as dummy:
             return False
 
+    def has_new_random_value(self, verification_method, domain_details):
+        # Check both that random values are now available, and that they're different than were returned to the previous 'check'
+        if verification_method == 'dns':
+            previous = (self.previous_domain_details.get('dnsMethod') or {}).get('recordValue')
+            value = (domain_details.get('dnsMethod') or {}).get('recordValue')
+            return bool(value) and value != previous
+        elif verification_method == 'web_server':
+            previous = (self.previous_domain_details.get('webServerMethod') or {}).get('fileContents')
+            value = (domain_details.get('webServerMethod') or {}).get('fileContents')
+            return bool(value) and value != previous
+        return True
+
+    def is_complete_write_response(self, verification_method, response):
+        # The response must contain everything set_domain_details() reads by key for this method, and the new random value
+        if not (response.get('verificationStatus') and response.get('clientId')):
+            return False
+        if (response.get('verificationMethod') or '').lower() != verification_method:
+            return False
+        if verification_method == 'dns':
+            method_details = response.get('dnsMethod') or {}
+            required_keys = ('recordDomain', 'recordType')
+        elif verification_method == 'web_server':
+            method_details = response.get('webServerMethod') or {}
+            required_keys = ('fileLocation', )
+        else:
+            return False
+        if any(key not in method_details for key in required_keys):
+            return False
+        return self.has_new_random_value(verification_method, response)
+
     def request_domain(self, module):
+        client_id = module.params['client_id']
+        domain_name = module.params['domain_name']
+        verification_method = module.params['verification_method']
+        verification_email = module.params['verification_email']
+        self.deadline = time.time() + REQUEST_TIMEOUT
         if not self.check(module):
             body = {}
 
-            body['verificationMethod'] = module.params['verification_method'].upper()
-            if module.params['verification_method'] == 'email':
+            body['verificationMethod'] = verification_method.upper()
+            if verification_method == 'email':
                 emailMethod = {}
-                if module.params['verification_email']:
+                if verification_email:
                     emailMethod['emailSource'] = 'SPECIFIED'
-                    emailMethod['email'] = module.params['verification_email']
+                    emailMethod['email'] = verification_email
                 else:
                     emailMethod['emailSource'] = 'INCLUDE_WHOIS'
                 body['emailMethod'] = emailMethod
             # Only populate domain name in body if it is not an existing domain
             if not self.domain_status:
-                body['domainName'] = module.params['domain_name']
+                body['domainName'] = domain_name
             try:
                 if not self.domain_status:
-                    self.ecs_client.AddDomain(clientId=module.params['client_id'], Body=body)
+                    result = call_with_retry(self.ecs_client.AddDomain, deadline=self.deadline, clientId=client_id, Body=body)
+                else:
+                    result = call_with_retry(self.ecs_client.ReverifyDomain, deadline=self.deadline, clientId=client_id, domain=domain_name, Body=body)
+
+                # For dns and web_server, only query the domain again if the response does not already contain its complete
+                # details including the new random value
+                if self.is_complete_write_response(verification_method, result):
+                    # Keep details such as OV/EV eligibility from 'check' that the response does not repeat
+                    domain_details = dict(self.previous_domain_details)
+                    domain_details.update(result)
+                    result = domain_details
                 else:
-                    self.ecs_client.ReverifyDomain(clientId=module.params['client_id'], domain=module.params['domain_name'], Body=body)
-
-                time.sleep(5)
-                result = self.ecs_client.GetDomain(clientId=module.params['client_id'], domain=module.params['domain_name'])
-
-                # It takes a bit of time before the random values are available
-                if module.params['verification_method'] == 'dns' or module.params['verification_method'] == 'web_server':
-                    for i in range(4):
-                        # Check both that random values are now available, and that they're different than were populated by previous 'check'
-                        if module.params['verification_method'] == 'dns':
-                            if result.get('dnsMethod') and result['dnsMethod']['recordValue'] != self.dns_contents:
-                                break
-                        elif module.params['verification_method'] == 'web_server':
-                            if result.get('webServerMethod') and result['webServerMethod']['fileContents'] != self.file_contents:
-                                break
-                    time.sleep(10)
-                    result = self.ecs_client.GetDomain(clientId=module.params['client_id'], domain=module.params['domain_name'])
+                    result = call_with_retry(self.ecs_client.GetDomain, deadline=self.deadline, clientId=client_id, domain=domain_name)
+
+                    # It takes a bit of time before the random values are available, so poll with an increasing delay
+                    if verification_method == 'dns' or verification_method == 'web_server':
+                        delay = POLL_INITIAL_DELAY
+                        deadline = min(time.time() + POLL_TIMEOUT, self.deadline)
+                        while not self.has_new_random_value(verification_method, result) and time.time() < deadline:
+                            time.sleep(min(delay, deadline - time.time()))
+                            delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY)
+                            result = call_with_retry(self.ecs_client.GetDomain, deadline=deadline, clientId=client_id, domain=domain_name)
                 self.changed = True
                 self.set_domain_details(result)
             except RestOperationException as e:
+                # Report invalid credentials with a clearer message than the failed request would give
+                if e.http_status in (401, 403):
+                    self.verify_credentials(module)
                 module.fail_json(msg='Failed to request domain validation from Entrust (ECS) {0}'.format(e.message))
 
     def dump(self):
@@ -417,7 +575,9 @@ def main():
         module.fail_json(msg='The verification_email field is invalid when verification_method="{0}".'.format(module.params['verification_method']))
 
     domain = EcsDomain(module)
-    domain.request_domain(module)
+    # Hold the lock while checking the domain as well, so a concurrent run picks up a validation that was just requested
+    with domain_request_lock(module.params['client_id'], module.params['domain_name']):
+        domain.request_domain(module)
     result = domain.dump()
     module.exit_json(**result)
 
@@ -0,0 +1,60 @@
+# Copyright (c) Ansible Project
+# GNU General Public License v3.0+ (see LICENSES/GPL-3.0-or-later.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+
+import io
+
+import pytest
+
+from ansible.module_utils.six.moves.urllib.error import HTTPError
+
+from ansible_collections.community.crypto.plugins.module_utils.ecs.api import (
+    RestOperation,
+    RestOperationException,
+)
+
+
+class FakeRequest(object):
+    def __init__(self, error):
+        self.error = error
+
+    def open(self, method, url, data=None):
+        raise self.error
+
+
+class FakeSession(object):
+    _spec = {'host': 'api.example.com', 'basePath': '/v1'}
+
+    def __init__(self, error):
+        self.request = FakeRequest(error)
+
+
+def make_http_error(code, body, headers):
+    return HTTPError('https://api.example.com/v1/domains', code, 'Error', headers, io.BytesIO(body))
+
+
+TEST_RESTMETHOD_HTTP_ERROR = [
+    # Status and Retry-After are taken from the HTTP response
+    (429, b'{"errors": [{"message": "Too many requests"}]}', {'Retry-After': '7'}, '429', '7', 'Too many requests'),
+    # A status given in the error body takes precedence, but the HTTP status is kept as well
+    (400, b'{"status": 422, "errors": [{"message": "Invalid"}]}', {}, '422', None, 'Invalid'),
+    (429, b'{"status": "Throttled", "errors": [{"message": "Slow down"}]}', {'Retry-After': '2'}, 'Throttled', '2', 'Slow down'),
+    # Responses without JSON body result in an error without message
+    (401, b'Unauthorized', {}, '401', None, ''),
+    (503, b'', {'Retry-After': '3'}, '503', '3', ''),
+]
+
+
+@pytest.mark.parametrize('code, body, headers, expected_status, expected_retry_after, expected_message', TEST_RESTMETHOD_HTTP_ERROR)
+def test_restmethod_http_error(code, body, headers, expected_status, expected_retry_after, expected_message):
+    op = RestOperation(FakeSession(make_http_error(code, body, headers)), '/domains', 'get')
+    with pytest.raises(RestOperationException) as exc:
+        op.restmethod()
+    assert exc.value.status == expected_status
+    assert exc.value.http_status == code
+    assert exc.value.retry_after == expected_retry_after
+    assert exc.value.message == expected_message
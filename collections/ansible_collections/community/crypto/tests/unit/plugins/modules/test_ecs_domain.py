@@ -0,0 +1,411 @@
+# Copyright (c) Ansible Project
+# GNU General Public License v3.0+ (see LICENSES/GPL-3.0-or-later.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import os
+import tempfile
+
+import pytest
+
+from ansible_collections.community.crypto.plugins.module_utils.ecs.api import RestOperationException
+from ansible_collections.community.crypto.plugins.modules import ecs_domain
+
+
+class DummyModule(object):
+    # module to mock AnsibleModule class
+    def __init__(self, **params):
+        self.params = dict(
+            entrust_api_user='user',
+            entrust_api_key='key',
+            entrust_api_client_cert_path='/path/to/cert',
+            entrust_api_client_cert_key_path='/path/to/key',
+            entrust_api_specification_path='/path/to/spec.yaml',
+            client_id=1,
+            domain_name='example.com',
+            verification_method='dns',
+            verification_email=None,
+        )
+        self.params.update(params)
+
+    def fail_json(self, msg=""):
+        raise ValueError(msg)
+
+
+class FakeClock(object):
+    # replacement for the time module, sleeping advances the clock
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeEcsClient(object):
+    # GetDomain returns the given responses in order, the last one repeatedly
+    def __init__(self, get_domain_responses, write_response=None, app_version_error=None):
+        self.get_domain_responses = list(get_domain_responses)
+        self.write_response = write_response if write_response is not None else {}
+        self.app_version_error = app_version_error
+        self.get_domain_calls = 0
+        self.write_calls = 0
+        self.app_version_calls = 0
+
+    def GetAppVersion(self):
+        self.app_version_calls += 1
+        if self.app_version_error is not None:
+            raise self.app_version_error
+        return {'version': '1.0'}
+
+    def GetDomain(self, clientId, domain):
+        self.get_domain_calls += 1
+        if len(self.get_domain_responses) > 1:
+            response = self.get_domain_responses.pop(0)
+        else:
+            response = self.get_domain_responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def AddDomain(self, clientId, Body):
+        return self.write(Body)
+
+    def ReverifyDomain(self, clientId, domain, Body):
+        return self.write(Body)
+
+    def write(self, body):
+        self.write_calls += 1
+        if isinstance(self.write_response, Exception):
+            raise self.write_response
+        return self.write_response
+
+
+def domain_details(status='RE_VERIFICATION', method='DNS', **extra):
+    result = {'verificationMethod': method, 'verificationStatus': status, 'clientId': 1}
+    result.update(extra)
+    return result
+
+
+def dns_details(record_value, status='RE_VERIFICATION'):
+    return domain_details(status=status, dnsMethod={
+        'recordDomain': '_pki-validation.example.com',
+        'recordType': 'TXT',
+        'recordValue': record_value,
+    })
+
+
+EXPIRED_DOMAIN = dns_details('old', status='EXPIRED')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    result = FakeClock()
+    monkeypatch.setattr(ecs_domain, 'time', result)
+    return result
+
+
+def request_domain(monkeypatch, client, **params):
+    monkeypatch.setattr(ecs_domain, 'ECSClient', lambda **kwargs: client)
+    module = DummyModule(**params)
+    domain = ecs_domain.EcsDomain(module)
+    domain.request_domain(module)
+    return domain.dump()
+
+
+def http_error(http_status, message='Error'):
+    return RestOperationException({'status': http_status, 'errors': [{'message': message}]}, http_status=http_status)
+
+
+def rate_limited(retry_after=None, status=429):
+    return RestOperationException({'status': status, 'errors': [{'message': 'Too many requests'}]}, retry_after=retry_after, http_status=429)
+
+
+class FlakyOperation(object):
+    # ECS API operation that raises the given exceptions before succeeding
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return kwargs
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    result = []
+    monkeypatch.setattr(ecs_domain.time, 'sleep', result.append)
+    return result
+
+
+# ===== call_with_retry tests =====
+
+TEST_CALL_WITH_RETRY = [
+    # Retry-After is respected
+    (['3', '3'], [3, 3]),
+    # Retry-After is capped
+    (['120'], [30]),
+    # Without Retry-After, the delay doubles
+    ([None, None, None], [1, 2, 4]),
+    # An HTTP date in Retry-After is ignored
+    (['Wed, 21 Oct 2015 07:28:00 GMT', None], [1, 2]),
+]
+
+
+@pytest.mark.parametrize('retry_afters, expected_sleeps', TEST_CALL_WITH_RETRY)
+def test_call_with_retry_rate_limited(sleeps, retry_afters, expected_sleeps):
+    operation = FlakyOperation([rate_limited(retry_after) for retry_after in retry_afters])
+    assert ecs_domain.call_with_retry(operation, clientId=1) == {'clientId': 1}
+    assert operation.calls == len(retry_afters) + 1
+    assert sleeps == expected_sleeps
+
+
+def test_call_with_retry_uses_http_status(sleeps):
+    # The status in the error body does not matter, only the HTTP status code
+    operation = FlakyOperation([rate_limited(status='Throttled')])
+    assert ecs_domain.call_with_retry(operation) == {}
+    assert operation.calls == 2
+    assert sleeps == [1]
+
+    operation = FlakyOperation([RestOperationException({'status': 429, 'errors': []}, http_status=400)])
+    with pytest.raises(RestOperationException) as exc:
+        ecs_domain.call_with_retry(operation)
+    assert exc.value.http_status == 400
+    assert operation.calls == 1
+
+
+def test_call_with_retry_deadline(clock):
+    operation = FlakyOperation([rate_limited('10'), rate_limited('10')])
+    with pytest.raises(RestOperationException):
+        ecs_domain.call_with_retry(operation, deadline=15)
+    assert operation.calls == 2
+    assert clock.sleeps == [10]
+
+
+def test_call_with_retry_gives_up(sleeps):
+    operation = FlakyOperation([rate_limited() for dummy in range(ecs_domain.RATE_LIMIT_RETRIES + 1)])
+    with pytest.raises(RestOperationException) as exc:
+        ecs_domain.call_with_retry(operation)
+    assert exc.value.http_status == 429
+    assert operation.calls == ecs_domain.RATE_LIMIT_RETRIES + 1
+    assert len(sleeps) == ecs_domain.RATE_LIMIT_RETRIES
+
+
+def test_call_with_retry_other_error(sleeps):
+    operation = FlakyOperation([RestOperationException({'status': 404, 'errors': [{'message': 'Not found'}]}, retry_after='5', http_status=404)])
+    with pytest.raises(RestOperationException) as exc:
+        ecs_domain.call_with_retry(operation)
+    assert exc.value.status == '404'
+    assert operation.calls == 1
+    assert sleeps == []
+
+
+# ===== request_domain polling tests =====
+
+def test_request_domain_new_value_available(monkeypatch, clock):
+    client = FakeEcsClient([EXPIRED_DOMAIN, dns_details('new')])
+    result = request_domain(monkeypatch, client)
+    assert result['changed'] is True
+    assert result['dns_contents'] == 'new'
+    assert client.get_domain_calls == 2
+    assert client.app_version_calls == 0
+    assert clock.sleeps == []
+
+
+def test_request_domain_polls_until_new_value(monkeypatch, clock):
+    client = FakeEcsClient([
+        EXPIRED_DOMAIN,
+        domain_details(),
+        dns_details(None),
+        domain_details(dnsMethod={'recordDomain': '_pki-validation.example.com', 'recordType': 'TXT'}),
+        dns_details('old'),
+        dns_details('new'),
+    ])
+    result = request_domain(monkeypatch, client)
+    assert result['dns_contents'] == 'new'
+    assert client.get_domain_calls == 6
+    assert clock.sleeps == pytest.approx([1.0, 1.6, 2.56, 4.096])
+
+
+def test_request_domain_polling_backoff_is_capped(monkeypatch, clock):
+    client = FakeEcsClient([EXPIRED_DOMAIN] + [dns_details(None)] * 7 + [dns_details('new')])
+    result = request_domain(monkeypatch, client)
+    assert result['dns_contents'] == 'new'
+    assert max(clock.sleeps) == ecs_domain.POLL_MAX_DELAY
+
+
+def test_request_domain_polling_times_out(monkeypatch, clock):
+    client = FakeEcsClient([EXPIRED_DOMAIN, dns_details('old')])
+    result = request_domain(monkeypatch, client)
+    assert result['dns_contents'] == 'old'
+    # The last GetDomain happened after the timeout, the one before it did not
+    assert clock.now >= ecs_domain.POLL_TIMEOUT
+    assert clock.now - clock.sleeps[-1] < ecs_domain.POLL_TIMEOUT
+    assert client.get_domain_calls == len(clock.sleeps) + 2
+
+
+def test_request_domain_web_server_polls_until_new_value(monkeypatch, clock):
+    def web_server_details(file_contents, status='RE_VERIFICATION'):
+        return domain_details(status=status, method='WEB_SERVER', webServerMethod={
+            'fileLocation': 'http://example.com/.well-known/pki-validation/abcd.txt',
+            'fileContents': file_contents,
+        })
+
+    client = FakeEcsClient([web_server_details('old', status='EXPIRED'), web_server_details(None), web_server_details('new')])
+    result = request_domain(monkeypatch, client, verification_method='web_server')
+    assert result['file_contents'] == 'new'
+    assert client.get_domain_calls == 3
+    assert len(clock.sleeps) == 1
+
+
+# ===== request_domain write response tests =====
+
+def test_request_domain_uses_complete_write_response(monkeypatch, clock):
+    expired_domain = dict(EXPIRED_DOMAIN, ovEligible=True, ovExpiry='2999-01-01T00:00:00Z')
+    client = FakeEcsClient([expired_domain], write_response=dns_details('new'))
+    result = request_domain(monkeypatch, client)
+    assert result['dns_contents'] == 'new'
+    assert result['dns_location'] == '_pki-validation.example.com'
+    assert result['domain_status'] == 'RE_VERIFICATION'
+    # Details not repeated in the response are kept from the initial GetDomain
+    assert result['ov_eligible'] is True
+    assert result['ov_days_remaining'] > 0
+    assert client.write_calls == 1
+    assert client.get_domain_calls == 1
+
+
+@pytest.mark.parametrize('write_response', [
+    {},
+    dns_details(None),
+    dns_details('old'),
+    {'dnsMethod': {'recordValue': 'new'}},
+    domain_details(dnsMethod={'recordValue': 'new'}),
+    domain_details(dnsMethod={'recordDomain': '_pki-validation.example.com', 'recordValue': 'new'}),
+    domain_details(method='WEB_SERVER', dnsMethod=dns_details('new')['dnsMethod']),
+    dict((key, value) for key, value in dns_details('new').items() if key != 'verificationMethod'),
+])
+def test_request_domain_ignores_incomplete_write_response(monkeypatch, clock, write_response):
+    client = FakeEcsClient([EXPIRED_DOMAIN, dns_details('newer')], write_response=write_response)
+    result = request_domain(monkeypatch, client)
+    assert result['dns_contents'] == 'newer'
+    assert client.get_domain_calls == 2
+
+
+def test_request_domain_email_always_queries_domain(monkeypatch, clock):
+    emails = ['admin@example.com']
+    client = FakeEcsClient(
+        [domain_details(status='EXPIRED', method='EMAIL'), domain_details(method='EMAIL', emailMethod=emails)],
+        write_response=domain_details(method='EMAIL'),
+    )
+    result = request_domain(monkeypatch, client, verification_method='email')
+    assert result['emails'] == emails
+    assert client.get_domain_calls == 2
+    assert clock.sleeps == []
+
+
+def test_request_domain_rate_limited_within_timeout(monkeypatch, clock):
+    client = FakeEcsClient([rate_limited('30')])
+    with pytest.raises(ValueError, match='Failed to request domain validation'):
+        request_domain(monkeypatch, client)
+    assert 0 < clock.now <= ecs_domain.REQUEST_TIMEOUT
+
+
+# ===== domain_request_lock tests =====
+
+@pytest.fixture
+def lock_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    return ecs_domain.get_domain_lock_path(1, 'example.com')
+
+
+def try_lock(path):
+    # Returns a file descriptor holding the lock, or None if the lock is held elsewhere
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        ecs_domain.fcntl.flock(fd, ecs_domain.fcntl.LOCK_EX | ecs_domain.fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return None
+    return fd
+
+
+def test_domain_request_lock_is_exclusive(lock_path, clock):
+    with ecs_domain.domain_request_lock(1, 'example.com'):
+        assert try_lock(lock_path) is None
+    fd = try_lock(lock_path)
+    assert fd is not None
+    os.close(fd)
+    assert clock.sleeps == []
+
+
+def test_domain_request_lock_waits_for_holder(lock_path, clock):
+    fd = try_lock(lock_path)
+    ran = []
+    try:
+        with ecs_domain.domain_request_lock(1, 'example.com'):
+            ran.append(clock.now)
+    finally:
+        os.close(fd)
+    assert ran == [ecs_domain.LOCK_TIMEOUT]
+    assert set(clock.sleeps) == set([ecs_domain.LOCK_POLL_INTERVAL])
+
+
+def test_domain_request_lock_refuses_symlink(lock_path, tmp_path, clock):
+    target = os.path.join(str(tmp_path), 'target')
+    os.symlink(target, lock_path)
+    ran = []
+    with ecs_domain.domain_request_lock(1, 'example.com'):
+        ran.append(True)
+    assert ran == [True]
+    assert not os.path.exists(target)
+    assert clock.sleeps == []
+
+
+def test_domain_request_lock_without_fcntl(monkeypatch, lock_path, clock):
+    monkeypatch.setattr(ecs_domain, 'HAS_FCNTL', False)
+    ran = []
+    with ecs_domain.domain_request_lock(1, 'example.com'):
+        ran.append(True)
+    assert ran == [True]
+    assert not os.path.exists(lock_path)
+
+
+def test_domain_request_lock_released_on_exit(lock_path, clock):
+    with pytest.raises(SystemExit):
+        with ecs_domain.domain_request_lock(1, 'example.com'):
+            raise SystemExit(1)
+    fd = try_lock(lock_path)
+    assert fd is not None
+    os.close(fd)
+
+
+# ===== credential verification tests =====
+
+@pytest.mark.parametrize('http_status', [401, 403])
+def test_request_domain_auth_error_verifies_credentials(monkeypatch, clock, http_status):
+    client = FakeEcsClient(
+        [http_error(http_status)],
+        write_response=http_error(http_status, 'Access denied'),
+        app_version_error=http_error(http_status, 'Invalid credentials'),
+    )
+    with pytest.raises(ValueError, match='Please verify credential information.*Invalid credentials'):
+        request_domain(monkeypatch, client)
+    assert client.write_calls == 1
+    assert client.app_version_calls == 1
+
+
+@pytest.mark.parametrize('error', [http_error(400, 'Invalid domain'), rate_limited()])
+def test_request_domain_other_error_skips_credentials(monkeypatch, clock, error):
+    client = FakeEcsClient([EXPIRED_DOMAIN], write_response=error)
+    with pytest.raises(ValueError, match='Failed to request domain validation'):
+        request_domain(monkeypatch, client)
+    assert client.app_version_calls == 0